@@ -1,3 +1,6 @@
+import gc
+from itertools import repeat
+
 import numpy as np
 import networkx as nx
 
@@ -9,7 +12,10 @@ from layer_grid import LayeredGrid
 
 from weather_model import WeatherSubmodel, AirCell
 from language_model import RandomLanguageModel, MarkovLanguage
-from sailing_model import Port, Ship, calculate_sea_lanes
+from sailing_model import (Port, Ship, SeaChart, SeaRouter, TrafficIndex,
+                           calculate_sea_lanes)
+from recorder import FieldRecorder
+from terrain_model import make_noise, make_land, label_islands, find_landlocked
 from utils import (weighted_random, make_weighted_syllables, make_word, 
                    make_place_name_model, rotate_vector)
 
@@ -18,14 +24,14 @@ class IslandCell:
     '''
     layer = "Land"
     
-    def __init__(self, pos, island):
+    def __init__(self, pos, island, landlocked=False):
         ''' Set a new tile of land.
         
         TODO: Any other properties the cell might have.
         '''
         self.pos = pos
         self.island = island
-        self.landlocked = False
+        self.landlocked = landlocked
 
 class Island(Agent):
     ''' An island is composed of multiple tiles.
@@ -71,28 +77,120 @@ class Person(Agent):
     
     def step(self):
         # Take a random step to an adjacent non-water tile
-        grid = self.model.grid
-        possible_steps = []
-        for x, y in grid.get_neighborhood(self.pos, True):
-            #if len(grid[x][y]) > 0:
-            if grid[x][y]["Land"] is not None:
-                possible_steps.append((x, y))
+        possible_steps = self.model.walkable.get_neighbors(self.pos)
+        if not possible_steps:
+            return
         next_step = self.random.choice(possible_steps)
         # TODO: Better logging of actions
         # print(f"{self.name} moved from {self.pos} to {next_step}")
-        grid.move_agent(self, next_step)
+        self.model.grid.move_agent(self, next_step)
+
+
+class WalkableNeighbors:
+    ''' Table of the land cells adjacent (with diagonals) to each land cell.
+    
+    Land never changes after setup, so this is worked out once instead of on
+    every step. Land cells are numbered in row-major order, and stored in 
+    compressed sparse row (CSR) form: the neighbors of land cell `i` are
+    `indices[indptr[i]:indptr[i + 1]]`.
+    '''
+    
+    def __init__(self, model):
+        self.land = model.land
+        cells = np.argwhere(self.land)
+        self.coordinates = cells
+        self.positions = [(int(x), int(y)) for x, y in cells]
+        # Number of each land cell, or -1 for the sea
+        self.index = np.full(self.land.shape, -1)
+        self.index[self.land] = np.arange(len(cells))
+        
+        neighbors = []
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                if dx == 0 and dy == 0:
+                    continue
+                shifted = np.roll(self.index, (-dx, -dy), axis=(0, 1))
+                neighbors.append(shifted[self.land])
+        neighbors = np.stack(neighbors, axis=1)
+        walkable = neighbors >= 0
+        self.indptr = np.concatenate([[0], np.cumsum(walkable.sum(axis=1))])
+        self.indices = neighbors[walkable]
+    
+    def get_neighbors(self, pos):
+        ''' Positions of the land cells adjacent to a land cell.
+        '''
+        x, y = pos
+        i = self.index[x, y]
+        return [self.positions[j] 
+                for j in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+
+class Population:
+    ''' A large crowd of walkers, stored as arrays instead of Person agents.
+    
+    Every walker takes the same kind of step as a Person, to a random land
+    cell next to it, but the whole population moves with a single vectorized
+    random draw against the WalkableNeighbors table. Walkers aren't placed on
+    the grid or scheduled.
+    '''
+    
+    def __init__(self, model, n_people):
+        self.model = model
+        self.walkable = model.walkable
+        self.rng = np.random.default_rng(model.random.getrandbits(32))
+        
+        # Pick a starting island, then a cell on it, for each walker
+        walkable = self.walkable
+        island_cells = [np.array([walkable.index[cell.pos] 
+                                  for cell in island.cells])
+                        for island in model.islands]
+        sizes = np.array([len(cells) for cells in island_cells])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        island_cells = np.concatenate(island_cells)
+        islands = self.rng.integers(len(model.islands), size=n_people)
+        offsets = (self.rng.random(n_people) * sizes[islands]).astype(int)
+        self.cells = island_cells[starts[islands] + offsets]
+    
+    def __len__(self):
+        return len(self.cells)
+    
+    @property
+    def positions(self):
+        ''' (x, y) coordinates of every walker, as an (n, 2) array.
+        '''
+        return self.walkable.coordinates[self.cells]
+    
+    def step(self):
+        ''' Move every walker to a random adjacent land cell, if it has one.
+        '''
+        indptr = self.walkable.indptr
+        start = indptr[self.cells]
+        n_options = indptr[self.cells + 1] - start
+        draw = self.rng.random(len(self.cells))
+        choice = start + (draw * n_options).astype(int)
+        can_move = n_options > 0
+        self.cells[can_move] = self.walkable.indices[choice[can_move]]
 
 
 class WorldModel(Model):
     
-    def __init__(self, n_islands=1, land_fraction=0.25, n_agents=100):
+    # Terrain generators, by name; each one fills in self.islands and the
+    # grid's "Land" layer
+    terrain_generators = {"growth": "grow_islands",
+                          "noise": "make_noise_islands"}
+    
+    def __init__(self, n_islands=1, land_fraction=0.25, n_agents=100,
+                 width=100, height=100,
+                 weather_every=1, weather_substeps=1, weather_resolution=1,
+                 weather_processes=1, navigation="all_pairs",
+                 weather_routing=False, terrain="growth", n_people=0):
         
         self.schedule = RandomActivation(self)
         self.running = True
         
         # Set world parameters
-        self.width = 100
-        self.height = 100
+        self.width = width
+        self.height = height
         #self.grid = MultiGrid(self.height, self.width, torus=True)
         self.grid = LayeredGrid(self.width, self.height, torus=True, 
                                 layers={"Land": "Single", 
@@ -103,7 +201,10 @@ class WorldModel(Model):
         # Set up islands
         self.n_islands = n_islands
         self.land_fraction = land_fraction
+        self.terrain = terrain
         self.islands = []
+        # Whether each cell is land, as an array
+        self.land = None
         self.make_islands()
         
         # Generate language
@@ -111,27 +212,48 @@ class WorldModel(Model):
         self.language = MarkovLanguage.make_psuedo_english()
         
         # Set up people
+        self.walkable = WalkableNeighbors(self)
         self.n_agents = n_agents
         # self.create_agents()
+        self.population = Population(self, n_people) if n_people else None
         
         # Set up seafaring: ports and shipping lanes
         self.ports = {}
         self.ports_per_island = 1
         self.create_ports()
-        self.sea_lanes = calculate_sea_lanes(self)
+        # Either precompute every port-to-port path, or chart them on demand
+        # over a hierarchy of sea regions (much cheaper on large maps)
+        self.navigation = navigation
+        if navigation == "hierarchical":
+            self.sea_lanes = SeaChart(self)
+        else:
+            self.sea_lanes = calculate_sea_lanes(self)
         
-        # Set up ships
+        # Set up ships, and keep track of where they are
+        self.traffic = TrafficIndex(self)
         self.make_ships()
         
         # Set up weather
-        self.weather = WeatherSubmodel(self)
+        self.weather = WeatherSubmodel(self, weather_every, weather_substeps,
+                                       weather_resolution, weather_processes)
         self.weather.setup_weather()
         
+        # Let ships reroute around bad weather
+        self.router = SeaRouter(self) if weather_routing else None
+        
+        # Field history recording; see start_recording
+        self.recorder = None
+        
         # Set up logging
         self.verbose = False
         self._log = []
     
     def make_islands(self):
+        ''' Generate the land, using the chosen terrain generator.
+        '''
+        getattr(self, self.terrain_generators[self.terrain])()
+    
+    def grow_islands(self):
         ''' Grow islands one random adjacent cell at a time.
         '''
         # Create islands
@@ -149,6 +271,56 @@ class WorldModel(Model):
         for _ in range(total_cells):
             island = self.random.choice(self.islands)
             island.grow()
+        self.land = np.array([[self.grid[x][y]["Land"] is not None 
+                               for y in range(self.height)]
+                              for x in range(self.width)])
+    
+    def make_noise_islands(self):
+        ''' Turn the highest points of some fractal noise into land.
+        
+        Much faster than growing the islands: the land is worked out with 
+        array operations, and then all the cells are made and put in the 
+        grid's "Land" layer in one go. The noise is sized to give roughly 
+        `n_islands` large islands, though there will usually be some smaller
+        islets as well; each one becomes an Island of its own.
+        '''
+        rng = np.random.default_rng(self.random.getrandbits(32))
+        scale = (self.width * self.height / self.n_islands)**0.5
+        noise = make_noise(self.width, self.height, scale, rng)
+        land = make_land(noise, self.land_fraction)
+        labels, n_islands = label_islands(land)
+        landlocked = find_landlocked(land)
+        self.land = land
+        
+        # Land cells, grouped by island
+        xs, ys = np.nonzero(land)
+        island_labels = labels[xs, ys]
+        order = np.argsort(island_labels, kind="stable")
+        xs, ys, island_labels = xs[order], ys[order], island_labels[order]
+        ends = np.searchsorted(island_labels, np.arange(1, n_islands + 1), 
+                               side="right")
+        
+        self.islands = [Island(i, self) for i in range(n_islands)]
+        landlocked = landlocked[xs, ys].tolist()
+        xs, ys = xs.tolist(), ys.tolist()
+        grid = self.grid.grid
+        # Making a million objects next to a big grid sets off a lot of slow,
+        # pointless garbage collection; none of them are garbage, so hold it
+        was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = 0
+            for island, end in zip(self.islands, ends.tolist()):
+                positions = list(zip(xs[start:end], ys[start:end]))
+                island.cells = list(map(IslandCell, positions, repeat(island),
+                                        landlocked[start:end]))
+                # Fill in the layer directly; these cells are known to be empty
+                for (x, y), cell in zip(positions, island.cells):
+                    grid[x][y]["Land"] = cell
+                start = end
+        finally:
+            if was_enabled:
+                gc.enable()
     
     def create_agents(self):
         ''' Create Person agents, who walk around on land.
@@ -174,6 +346,7 @@ class WorldModel(Model):
             ship = Ship(name, name, self, port)
             self.grid.place_agent(ship, port.pos)
             self.schedule.add(ship)
+            self.traffic.add_ship(ship)
     
     def create_ports(self):
         ''' Choose random non-landlocked island cell for a port 
@@ -196,8 +369,34 @@ class WorldModel(Model):
     
 
     def step(self):
-        self.weather.weather_step()
+        self.weather.step()
         self.schedule.step()
+        if self.population is not None:
+            self.population.step()
+        if self.recorder is not None:
+            self.recorder.record(self)
+    
+    def start_recording(self, path, **kwargs):
+        ''' Record the weather and ship density fields to `path` as the model
+        runs. Keyword arguments are passed on to FieldRecorder.
+        '''
+        self.stop_recording()
+        self.recorder = FieldRecorder(path, **kwargs)
+    
+    def stop_recording(self):
+        ''' Finish writing the recording, if there is one.
+        '''
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+    
+    def close(self):
+        ''' Finish any recording and shut down the weather workers, freeing
+        their shared memory. Call this when done with a model that has
+        `weather_processes` > 1.
+        '''
+        self.stop_recording()
+        self.weather.close()
     
     def log(self, message):
         log_entry = f"{self.schedule.steps}: {message}"
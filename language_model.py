@@ -7,7 +7,10 @@ Collect all the code needed to generate random names for people, places, ships
 import string
 import random
 import json
+import hashlib
+import os
 from collections import defaultdict
+from collections.abc import Mapping, Sequence
 import numpy as np
 
 import tracery
@@ -88,6 +91,118 @@ class RandomLanguageModel:
         grammar = tracery.Grammar(self.grammar)
         return grammar.flatten("#ship_name#")
     
+def encode_strings(strings):
+    ''' Pack a list of strings into one array of null-separated UTF-8 bytes.
+    '''
+    return np.frombuffer("\0".join(strings).encode("utf-8"), dtype=np.uint8)
+
+def decode_strings(data):
+    return bytes(data).decode("utf-8").split("\0")
+
+# Version of the layout written by `save_tables` and `MarkovChain.get_tables`;
+# bump it whenever either changes, so old cache files are ignored
+TABLES_VERSION = 1
+
+def save_tables(path, tables):
+    ''' Write a dictionary of 1-d arrays to one file that `load_tables` can
+    memory-map.
+
+    The file is a JSON header giving the format version and each array's
+    dtype, length and offset, followed by the raw arrays. It's written to a
+    temporary file first and then renamed, so processes racing to build the
+    same cache never see a partial one.
+    '''
+    layout = {}
+    offset = 0
+    for name, values in tables.items():
+        offset += -offset % 8 # Keep every array aligned
+        layout[name] = [values.dtype.str, len(values), offset]
+        offset += values.nbytes
+    header = json.dumps({"version": TABLES_VERSION,
+                         "arrays": layout}).encode("utf-8")
+    start = 8 + len(header)
+    start += -start % 8
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, values in tables.items():
+            f.seek(start + layout[name][2])
+            f.write(values.tobytes())
+    os.replace(temp_path, path)
+
+def load_tables(path):
+    ''' Memory-map the arrays saved by `save_tables`, read-only.
+
+    The operating system shares the mapped pages between every process that
+    loads the same file. Raises an exception if the file is from another
+    version of the format, or is cut short.
+    '''
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    header_length = int.from_bytes(data[:8].tobytes(), "little")
+    header = json.loads(data[8:8 + header_length].tobytes())
+    if header.get("version") != TABLES_VERSION:
+        raise Exception(f"{path} is not version {TABLES_VERSION} tables")
+    start = 8 + header_length
+    start += -start % 8
+    tables = {}
+    for name, (dtype, length, offset) in header["arrays"].items():
+        dtype = np.dtype(dtype)
+        begin = start + offset
+        end = begin + length * dtype.itemsize
+        if end > len(data):
+            raise Exception(f"{path} is truncated")
+        tables[name] = data[begin:end].view(dtype)
+    return tables
+
+class Followers(Sequence):
+    ''' The symbols that can follow one token, read from the packed arrays.
+    '''
+
+    def __init__(self, symbols, followers):
+        self.symbols = symbols
+        self.followers = followers
+
+    def __len__(self):
+        return len(self.followers)
+
+    def __getitem__(self, i):
+        return self.symbols[self.followers[i]]
+
+class TransitionTable(Mapping):
+    ''' Read-only stand-in for `MarkovChain.transitions`, backed by the arrays
+    from `MarkovChain.get_tables` (which may be memory-mapped).
+    '''
+
+    def __init__(self, tables):
+        tokens = decode_strings(tables["tokens"])
+        self.token_index = {token: i for i, token in enumerate(tokens)}
+        self.symbols = decode_strings(tables["symbols"])
+        self.indptr = tables["indptr"]
+        self.followers = tables["followers"]
+        if (len(self.indptr) != len(tokens) + 1
+                or self.indptr[-1] != len(self.followers)
+                or np.any(np.diff(self.indptr.astype(np.int64)) < 0)
+                or (len(self.followers)
+                    and self.followers.max() >= len(self.symbols))):
+            raise Exception("Transition tables are inconsistent")
+
+    def __getitem__(self, token):
+        i = self.token_index[token]
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return Followers(self.symbols, self.followers[start:end])
+
+    def __iter__(self):
+        return iter(self.token_index)
+
+    def __len__(self):
+        return len(self.token_index)
+
+    def copy(self):
+        ''' Unpack into a regular (trainable) transitions dictionary.
+        '''
+        return defaultdict(list, {token: list(self[token]) for token in self})
+
 class MarkovChain:
     ''' Train an n-order Markov chain and generate words from it.
     
@@ -108,12 +223,43 @@ class MarkovChain:
     def train(self, vocabulary, replace=False):
         if replace:
             self.transitions = defaultdict(list)
+        elif not isinstance(self.transitions, defaultdict):
+            # Loaded from a cache; copy it out before adding to it
+            self.transitions = self.transitions.copy()
         for word in vocabulary:
             self.transitions["<START>"].append(word[:self.order])
             for i in range(self.order, len(word)):
                 self.transitions[word[i-self.order:i]].append(word[i])
             self.transitions[word[-self.order:]].append("<END>")
     
+    def get_tables(self):
+        ''' Pack the transitions into flat arrays, for caching.
+    
+        Tokens and the symbols that can follow them are stored once each, as
+        strings; the followers of token i are
+        symbols[followers[indptr[i]:indptr[i + 1]]], in training order.
+        '''
+        tokens = sorted(self.transitions)
+        symbols = sorted({symbol for followers in self.transitions.values()
+                          for symbol in followers})
+        symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+        indptr = np.cumsum([0] + [len(self.transitions[token])
+                                  for token in tokens], dtype=np.uint32)
+        followers = np.array([symbol_index[symbol] for token in tokens
+                              for symbol in self.transitions[token]],
+                             dtype=np.uint32)
+        return {"tokens": encode_strings(tokens),
+                "symbols": encode_strings(symbols),
+                "indptr": indptr, "followers": followers}
+    
+    @classmethod
+    def from_tables(cls, order, tables):
+        ''' Make a trained chain from arrays made by `get_tables`.
+        '''
+        chain = cls(order)
+        chain.transitions = TransitionTable(tables)
+        return chain
+    
     def generate(self):
         word = ""
         token = "<START>"
@@ -154,18 +300,66 @@ class MarkovLanguage:
         '''
         pass
     
+    def get_tables(self):
+        ''' Both chains' transitions as flat arrays; see `save_tables`
+        '''
+        tables = {}
+        for prefix, model in [("name", self.name_model),
+                              ("place", self.place_model)]:
+            for key, values in model.get_tables().items():
+                tables[f"{prefix}_{key}"] = values
+        return tables
+    
     @classmethod
-    def make_psuedo_english(cls, order=2):
+    def from_tables(cls, tables, order=2):
+        ''' Make an already-trained language from `get_tables` arrays
+        '''
+        language = cls([], [], order)
+        for prefix in ["name", "place"]:
+            chain_tables = {key[len(prefix) + 1:]: values
+                            for key, values in tables.items()
+                            if key.startswith(prefix + "_")}
+            chain = MarkovChain.from_tables(order, chain_tables)
+            setattr(language, f"{prefix}_model", chain)
+        return language
+    
+    @classmethod
+    def make_psuedo_english(cls, order=2, cache_dir="corpora/cache"):
         ''' Make Markov chain of English names from hard-coded corpora
+    
+        The trained chains are cached in `cache_dir` (unless it's None), in a
+        file keyed on a hash of the corpora and the order. Later calls -- in
+        this process or any other -- memory-map the cache instead of
+        retraining, so worker processes all share one read-only copy.
         '''
+    
+        with open("corpora/english_towns_cities.json", "rb") as f:
+            place_data = f.read()
+        with open("corpora/firstNames.json", "rb") as f:
+            name_data = f.read()
+    
+        if cache_dir is not None:
+            key = hashlib.sha256(place_data + b"\0" + name_data).hexdigest()
+            cache_path = os.path.join(
+                cache_dir, f"markov_v{TABLES_VERSION}_{key[:16]}_{order}.bin")
+            if os.path.exists(cache_path):
+                try:
+                    return cls.from_tables(load_tables(cache_path), order)
+                except Exception:
+                    pass  # Unreadable or damaged; retrain and replace it
+    
+        place_corpus = json.loads(place_data)
+        town_names = place_corpus["towns"] + place_corpus["cities"]
+        first_names = json.loads(name_data)["firstNames"]
+        language = cls(first_names, town_names, order)
+    
+        if cache_dir is not None:
+            # The cache is only a speed-up, so carry on without it if it
+            # can't be written
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_tables(cache_path, language.get_tables())
+            except OSError:
+                pass
+        return language
         
-        with open("corpora/english_towns_cities.json") as f:
-            place_corpus = json.load(f)
-            town_names = place_corpus["towns"] + place_corpus["cities"]
-        
-        with open("corpora/firstNames.json") as f:
-            name_corpus = json.load(f)
-            first_names = name_corpus["firstNames"]
-        
-        return cls(first_names, town_names, order)
-        
\ No newline at end of file
@@ -0,0 +1,220 @@
+'''
+Field recorder
+
+Keeps the full history of the per-cell fields -- temperature, humidity, cloud
+cover and ship density -- on disk for offline analysis. Snapshots are
+collected into chunks of steps, and each chunk is written out by a background
+thread so the model doesn't wait on the disk.
+
+Each chunk is either one compressed .npz file, or (with compress=False) one
+plain .npy file per field, which can be memory-mapped when read back. An
+index.json file in the same directory describes the chunks written so far.
+'''
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+RECORDED_FIELDS = ["temperature", "humidity", "cloudy", "ship_density"]
+
+
+def get_snapshot(model, fields=RECORDED_FIELDS):
+    ''' Current values of the recorded fields, as arrays.
+
+    The weather fields are at the weather grid's resolution, which may be
+    coarser than the world's.
+    '''
+    snapshot = {}
+    for name in fields:
+        if name == "ship_density":
+            snapshot[name] = model.traffic.cell_counts.astype(np.int32)
+        else:
+            snapshot[name] = model.weather.fields[name].copy()
+    return snapshot
+
+
+class FieldRecorder:
+    ''' Append snapshots of the model's fields to a chunked on-disk store.
+    '''
+
+    def __init__(self, path, fields=RECORDED_FIELDS, every=1, dtype="float16",
+                 chunk_size=64, compress=True, max_pending=4):
+        ''' Start a new recording.
+
+        Args:
+            path: Directory to write the recording to
+            fields: Names of the fields to record
+            every: Only record every this many steps
+            dtype: Type to downcast floating-point fields to, or None to keep
+                   them as they are
+            chunk_size: Number of snapshots per file
+            compress: Whether to compress the files; uncompressed ones can be
+                      memory-mapped when read back
+            max_pending: Most chunks to hold in memory waiting to be written;
+                         past that, recording waits for the disk to catch up
+        '''
+        self.path = path
+        self.fields = list(fields)
+        self.every = every
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.chunk_size = chunk_size
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+
+        self.index = {"fields": {}, "every": every, "compress": compress,
+                      "chunks": []}
+        self.buffer = []
+        self.steps = []
+
+        # First exception raised by the writer thread, if any
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def record(self, model):
+        ''' Take a snapshot, if this is a step that gets recorded.
+        '''
+        self.check_error()
+        step = model.schedule.steps
+        if step % self.every != 0:
+            return
+        snapshot = get_snapshot(model, self.fields)
+        for name, values in snapshot.items():
+            if self.dtype is not None and values.dtype.kind == "f":
+                snapshot[name] = values.astype(self.dtype)
+        self.buffer.append(snapshot)
+        self.steps.append(step)
+        if len(self.buffer) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        ''' Hand the snapshots taken so far over to the writer thread.
+        '''
+        self.check_error()
+        if not self.buffer:
+            return
+        chunk = {name: np.stack([snapshot[name] for snapshot in self.buffer])
+                 for name in self.fields}
+        chunk["step"] = np.array(self.steps)
+        self.queue.put(chunk)
+        self.buffer = []
+        self.steps = []
+
+    def check_error(self):
+        ''' Raise the writer thread's exception here, if it had one.
+        '''
+        if self.error is not None:
+            raise Exception(f"Writing the recording to {self.path} "
+                            "failed") from self.error
+
+    def write_chunks(self):
+        ''' Writer thread: save chunks as they come in.
+
+        If saving one fails, keep the exception for the main thread to raise,
+        and throw away anything else that comes in so it isn't kept waiting.
+        '''
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write_chunk(chunk)
+            except Exception as e:
+                self.error = e
+
+    def write_chunk(self, chunk):
+        ''' Save one chunk, and update the index.
+        '''
+        number = len(self.index["chunks"])
+        if self.compress:
+            files = {"all": f"chunk{number:05d}.npz"}
+            np.savez_compressed(os.path.join(self.path, files["all"]),
+                                **chunk)
+        else:
+            files = {name: f"{name}.{number:05d}.npy" for name in chunk}
+            for name, values in chunk.items():
+                np.save(os.path.join(self.path, files[name]), values)
+        for name in self.fields:
+            self.index["fields"][name] = {
+                "shape": list(chunk[name].shape[1:]),
+                "dtype": chunk[name].dtype.str}
+        self.index["chunks"].append({"files": files,
+                                     "steps": chunk["step"].tolist()})
+        # Write the index atomically, so readers never see half of one
+        index_path = os.path.join(self.path, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def close(self):
+        ''' Write out whatever's left and wait for the writer to finish.
+
+        Raises an exception if any of the recording couldn't be written.
+        '''
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.writer.join()
+        self.check_error()
+
+
+class FieldHistory:
+    ''' Lazy, read-only view of one recorded field over time.
+
+    Index it by snapshot number (not model step) to get arrays; chunks are
+    only read from disk when they're needed, and are memory-mapped if the
+    recording wasn't compressed. `steps` holds the model step of each
+    snapshot.
+    '''
+
+    def __init__(self, path, name, index):
+        self.path = path
+        self.name = name
+        self.compress = index["compress"]
+        self.chunks = index["chunks"]
+        self.shape = tuple(index["fields"][name]["shape"])
+        self.dtype = np.dtype(index["fields"][name]["dtype"])
+        self.steps = np.array([step for chunk in self.chunks
+                               for step in chunk["steps"]], dtype=int)
+        # Snapshot number at the start of each chunk
+        self.starts = np.cumsum([0] + [len(chunk["steps"])
+                                       for chunk in self.chunks])
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def get_chunk(self, number):
+        if number not in self.loaded:
+            files = self.chunks[number]["files"]
+            if self.compress:
+                with np.load(os.path.join(self.path, files["all"])) as data:
+                    self.loaded = {number: data[self.name]}
+            else:
+                self.loaded[number] = np.load(
+                    os.path.join(self.path, files[self.name]), mmap_mode="r")
+        return self.loaded[number]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return np.stack([self[j] for j in range(*i.indices(len(self)))])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Snapshot index out of range")
+        number = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return self.get_chunk(number)[i - self.starts[number]]
+
+def load_recording(path):
+    ''' Open a recording, as a dictionary of field names to FieldHistory.
+    '''
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+    return {name: FieldHistory(path, name, index) for name in index["fields"]}
@@ -2,9 +2,14 @@
 
 
 '''
+from bisect import bisect_right
+from collections import Counter, deque, namedtuple, OrderedDict
+import heapq
+from collections.abc import Mapping, Sequence
 from itertools import product
 
 import networkx as nx
+import numpy as np
 
 from mesa import Agent
 
@@ -32,6 +37,8 @@ class Ship(Agent):
         self.current_port = starting_port.name
         self.pos = starting_port.pos
         self.log = []
+        # Weather epoch the course was last checked in
+        self.course_checked = None
     
     def choose_destination(self):
         ''' Chart a course to a random port.
@@ -45,13 +52,39 @@ class Ship(Agent):
         self.condition = "Sailing"
         self.current_step = 0
         self.path = self.model.sea_lanes[(self.current_port, self.destination)]
+        self.model.traffic.depart(self, self.current_port, self.destination)
         log_msg = f"{self.name} departed {self.current_port} for {self.destination}"
         self.model.log(log_msg)
         self.log.append(log_msg)
     
+    def check_course(self):
+        ''' Reroute if there's rain on the path ahead.
+        
+        Only done once per weather epoch, and only if the model has a router.
+        Goes by the router's view of the weather, which it plans routes with.
+        '''
+        router = self.model.router
+        if router is None or self.course_checked == router.epoch:
+            return
+        self.course_checked = router.epoch
+        ahead = self.path[self.current_step + 1:
+                          self.current_step + 1 + router.lookahead]
+        if not router.is_raining(ahead):
+            return
+        path = router.route(self.pos, self.destination)
+        if path is None:
+            return
+        self.path = path
+        self.current_step = 0
+        log_msg = f"{self.name} changed course to avoid rain"
+        self.model.log(log_msg)
+        self.log.append(log_msg)
+    
     def sail(self):
+        self.check_course()
         self.current_step += 1
         if self.current_step == len(self.path):
+            self.model.traffic.arrive(self, self.current_port, self.destination)
             self.condition = "At port"
             self.current_port = self.destination
             self.destination = None
@@ -61,6 +94,7 @@ class Ship(Agent):
             return
             
         next_step = self.path[self.current_step]
+        self.model.traffic.move(self.pos, next_step)
         self.model.grid.move_agent(self, next_step)
     
     def add_to_log(self):
@@ -144,4 +178,490 @@ def calculate_sea_lanes(model):
             except:
                 print(f"Could not find path between {start_name} and {end_name}")
     return sea_lanes
-            
\ No newline at end of file
+
+
+def get_sea(model):
+    ''' Whether each cell is open water, as lists indexed [x][y].
+    '''
+    return (~model.land).tolist()
+
+def get_neighbors(pos, width, height):
+    ''' The four cells next to a cell (no diagonals), on the torus.
+    '''
+    x, y = pos
+    return [((x + 1) % width, y), ((x - 1) % width, y),
+            (x, (y + 1) % height), (x, (y - 1) % height)]
+
+def toroidal_manhattan(model, pos_1, pos_2):
+    ''' Fewest steps between two cells with no diagonal moves, on the torus.
+    '''
+    dx = abs(pos_1[0] - pos_2[0])
+    dy = abs(pos_1[1] - pos_2[1])
+    return min(dx, model.width - dx) + min(dy, model.height - dy)
+
+class LazyPath(Sequence):
+    ''' A path of cells that is only worked out a segment at a time.
+    
+    Built from the waypoints of a hierarchical route; each segment between
+    two waypoints is refined into cells by the `SeaChart` the first time a
+    cell in it is asked for. Its length is known up front, so a `Ship` can
+    sail it exactly like a plain list of cells.
+    '''
+    
+    def __init__(self, chart, segments):
+        '''
+        Args:
+            chart: The SeaChart that refines the segments
+            segments: List of (start, end, cluster, length) tuples
+        '''
+        self.chart = chart
+        self.start = segments[0][0]
+        self.segments = segments
+        self.cells = [None] * len(segments)
+        # Index into the path of the last cell of each segment
+        self.ends = []
+        total = 0
+        for segment in segments:
+            total += segment[3]
+            self.ends.append(total)
+    
+    def __len__(self):
+        return self.ends[-1] + 1
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Path index out of range")
+        if i == 0:
+            return self.start
+        k = bisect_right(self.ends, i - 1)
+        if self.cells[k] is None:
+            self.cells[k] = self.chart.refine(*self.segments[k][:3])
+        start = self.ends[k - 1] if k > 0 else 0
+        return self.cells[k][i - start - 1]
+
+class SeaChart(Mapping):
+    ''' Hierarchical sea navigation (HPA*), as a drop-in for `sea_lanes`.
+    
+    The sea is cut into square clusters. Wherever open water crosses the
+    border between two clusters, the middle of each stretch of crossing
+    becomes an entrance, and entrances in the same cluster are linked by
+    their shortest distance within it. Port-to-port routes are found by A*
+    over this small graph of entrances, and only turned into cells one
+    segment at a time as a ship sails them.
+    
+    Acts as a read-only mapping of (start port, end port) names to paths, the
+    same as the dictionary from `calculate_sea_lanes`; routes are computed
+    the first time they're asked for. Unlike those lanes, every step costs the
+    same, so ships take the shortest routes.
+    '''
+    
+    def __init__(self, model, cluster_size=10):
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        self.cluster_size = cluster_size
+        self.sea = get_sea(model)
+        
+        self.graph = nx.Graph()
+        self.make_entrances()
+        self.link_entrances()
+        
+        self.routes = {}
+        self.refined = {}
+    
+    def get_cluster(self, pos):
+        x, y = pos
+        return (x // self.cluster_size, y // self.cluster_size)
+    
+    def make_entrances(self):
+        ''' Add an entrance pair to the graph for each stretch of open water
+        crossing a border between clusters.
+        '''
+        size = self.cluster_size
+        # The last column and row border the first ones, across the torus
+        columns = list(range(size - 1, self.width - 1, size)) + [self.width - 1]
+        rows = list(range(size - 1, self.height - 1, size)) + [self.height - 1]
+        for x in columns:
+            next_x = (x + 1) % self.width
+            for y0 in range(0, self.height, size):
+                crossings = [(x, y) for y in range(y0, min(y0 + size, 
+                                                            self.height))
+                             if self.sea[x][y] and self.sea[next_x][y]]
+                for cell in self.get_crossings(crossings):
+                    self.graph.add_edge(cell, (next_x, cell[1]), weight=1,
+                                        cluster=None)
+        for y in rows:
+            next_y = (y + 1) % self.height
+            for x0 in range(0, self.width, size):
+                crossings = [(x, y) for x in range(x0, min(x0 + size, 
+                                                            self.width))
+                             if self.sea[x][y] and self.sea[x][next_y]]
+                for cell in self.get_crossings(crossings):
+                    self.graph.add_edge(cell, (cell[0], next_y), weight=1,
+                                        cluster=None)
+    
+    @staticmethod
+    def get_crossings(cells):
+        ''' The middle cell of each contiguous run in a list of border cells.
+        '''
+        runs = []
+        for cell in cells:
+            last = runs[-1][-1] if runs else None
+            if last and abs(cell[0] - last[0]) + abs(cell[1] - last[1]) == 1:
+                runs[-1].append(cell)
+            else:
+                runs.append([cell])
+        return [run[len(run) // 2] for run in runs]
+    
+    def search_cluster(self, start, cluster, goal=None):
+        ''' Breadth-first search from `start` over the sea within a cluster.
+        
+        The start and goal may be outside the cluster or on land, for ports;
+        the search doesn't continue past the goal. Returns dictionaries of 
+        each cell reached to its parent, and to its distance from the start.
+        '''
+        size = self.cluster_size
+        x0, y0 = cluster[0] * size, cluster[1] * size
+        x1, y1 = x0 + size, y0 + size
+        sea = self.sea
+        width, height = self.width, self.height
+        parents = {start: None}
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            cell = queue.popleft()
+            if cell == goal and cell != start:
+                continue
+            distance = distances[cell] + 1
+            for neighbor in get_neighbors(cell, width, height):
+                if neighbor in parents:
+                    continue
+                i, j = neighbor
+                if neighbor == goal or (x0 <= i < x1 and y0 <= j < y1 
+                                        and sea[i][j]):
+                    parents[neighbor] = cell
+                    distances[neighbor] = distance
+                    queue.append(neighbor)
+        return parents, distances
+    
+    def link_entrances(self):
+        ''' Connect the entrances in each cluster by their distances within it.
+        '''
+        clusters = {}
+        for entrance in self.graph.nodes:
+            clusters.setdefault(self.get_cluster(entrance), []).append(entrance)
+        for cluster, entrances in clusters.items():
+            for i, entrance in enumerate(entrances[:-1]):
+                _, distances = self.search_cluster(entrance, cluster)
+                for other in entrances[i + 1:]:
+                    if other in distances:
+                        self.graph.add_edge(entrance, other, cluster=cluster,
+                                            weight=distances[other])
+    
+    def connect_port(self, port, temporary, other=None):
+        ''' Link a port into the graph, via every cluster its shore touches.
+        
+        Also links it straight to the `other` port, if that's reachable 
+        within one of those clusters. Records the edges added in `temporary`,
+        to be removed after the search.
+        '''
+        neighbors = get_neighbors(port.pos, self.width, self.height)
+        clusters = {self.get_cluster(cell) for cell in neighbors
+                    if self.sea[cell[0]][cell[1]]}
+        for cluster in clusters:
+            goal = other.pos if other is not None else None
+            _, distances = self.search_cluster(port.pos, cluster, goal)
+            for node, distance in distances.items():
+                if node == port.pos or node not in self.graph:
+                    continue
+                if self.graph.has_edge(port.pos, node):
+                    if self.graph.edges[port.pos, node]["weight"] <= distance:
+                        continue
+                else:
+                    temporary.append((port.pos, node))
+                self.graph.add_edge(port.pos, node, cluster=cluster,
+                                    weight=distance)
+    
+    def find_route(self, start_name, end_name):
+        ''' Find the waypoints from one port to another with A*.
+        '''
+        start = self.model.ports[start_name]
+        end = self.model.ports[end_name]
+        temporary = []
+        self.graph.add_node(start.pos)
+        self.graph.add_node(end.pos)
+        try:
+            self.connect_port(start, temporary, end)
+            self.connect_port(end, temporary)
+            heuristic = lambda a, b: toroidal_manhattan(self.model, a, b)
+            waypoints = nx.astar_path(self.graph, start.pos, end.pos,
+                                      heuristic=heuristic, weight="weight")
+            segments = []
+            for a, b in zip(waypoints, waypoints[1:]):
+                edge = self.graph.edges[a, b]
+                segments.append((a, b, edge["cluster"], edge["weight"]))
+            return segments
+        except nx.NetworkXNoPath:
+            return None
+        finally:
+            self.graph.remove_edges_from(temporary)
+            for pos in [start.pos, end.pos]:
+                if self.graph.degree(pos) == 0:
+                    self.graph.remove_node(pos)
+    
+    def refine(self, start, end, cluster):
+        ''' Turn one segment of a route into cells, excluding the start.
+        '''
+        key = (start, end, cluster)
+        if key not in self.refined:
+            if cluster is None:
+                cells = [end]
+            else:
+                parents, _ = self.search_cluster(start, cluster, end)
+                cells = []
+                cell = end
+                while cell != start:
+                    cells.append(cell)
+                    cell = parents[cell]
+                cells.reverse()
+            self.refined[key] = cells
+        return self.refined[key]
+    
+    def __getitem__(self, key):
+        if key not in self.routes:
+            start_name, end_name = key
+            if start_name == end_name or start_name not in self.model.ports \
+                    or end_name not in self.model.ports:
+                raise KeyError(key)
+            self.routes[key] = self.find_route(start_name, end_name)
+        if self.routes[key] is None:
+            raise KeyError(key)
+        return LazyPath(self, self.routes[key])
+    
+    def __iter__(self):
+        for key in product(self.model.ports, repeat=2):
+            if key in self:
+                yield key
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+class SeaRouter:
+    ''' On-demand, weather-aware routing from any sea cell to any port.
+    
+    Routes are found with A* over the sea cells, where each step costs more
+    if it's cloudy or raining there. The weather costs are only refreshed
+    once per routing epoch (every `epoch_length` weather steps), and routes
+    are kept in a bounded LRU cache keyed on (cell, destination, epoch). 
+    
+    Every cell along a route is cached too, pointing at the rest of the
+    route from there. So ships turning away from the same storm, or already
+    following a route someone else found, share one search between them.
+    '''
+    
+    # Extra cost to sail through a cell
+    cloud_cost = 0.5
+    rain_cost = 5
+    
+    def __init__(self, model, maxsize=10000, epoch_length=5, lookahead=5):
+        '''
+        Args:
+            model: The parent model
+            maxsize: Most cells to keep cached routes from
+            epoch_length: Number of weather steps the weather costs are 
+                          reused for
+            lookahead: How many cells ahead ships check for rain
+        '''
+        self.model = model
+        self.width = model.width
+        self.height = model.height
+        self.maxsize = maxsize
+        self.epoch_length = epoch_length
+        self.lookahead = lookahead
+        self.sea = get_sea(model)
+        
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.costs = None
+        self.raining = None
+        self.costs_epoch = None
+    
+    @property
+    def epoch(self):
+        return self.model.weather.epoch // self.epoch_length
+    
+    def get_costs(self):
+        ''' Cost of sailing into each cell, from this epoch's weather.
+        
+        Uses the weather as ships see it from each cell (interpolated, if
+        the weather runs at a coarser resolution), and keeps where it's
+        raining for `is_raining`, so both agree all epoch.
+        '''
+        if self.costs_epoch != self.epoch:
+            cloudy, raining = self.model.weather.get_sky()
+            costs = 1 + self.cloud_cost * cloudy + self.rain_cost * raining
+            self.costs = costs.tolist()
+            self.raining = raining.tolist()
+            self.costs_epoch = self.epoch
+        return self.costs
+    
+    def is_raining(self, cells):
+        ''' Whether it's raining, by this epoch's weather, on any of the cells.
+        '''
+        self.get_costs()
+        return any(self.raining[x][y] for x, y in cells)
+    
+    def route(self, cell, destination):
+        ''' Get a path from a cell to a port, or None if there isn't one.
+        
+        The path is a list of cells, starting with `cell` and ending with the
+        port.
+        '''
+        key = (cell, destination, self.epoch)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            path, start = self.cache[key]
+            return list(path[start:])
+        self.misses += 1
+        
+        path = self.search(cell, self.model.ports[destination].pos)
+        if path is None:
+            return None
+        path = tuple(path)
+        for i, step in enumerate(path[:-1]):
+            step_key = (step, destination, key[2])
+            self.cache[step_key] = (path, i)
+            self.cache.move_to_end(step_key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return list(path)
+    
+    def search(self, start, goal):
+        ''' A* from a cell to a goal cell over the sea, with weather costs.
+        '''
+        costs = self.get_costs()
+        sea = self.sea
+        width, height = self.width, self.height
+        heuristic = lambda pos: toroidal_manhattan(self.model, pos, goal)
+        
+        parents = {start: None}
+        distances = {start: 0}
+        queue = [(heuristic(start), 0, start)]
+        while queue:
+            _, distance, cell = heapq.heappop(queue)
+            if cell == goal:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = parents[cell]
+                path.reverse()
+                return path
+            if distance > distances[cell]:
+                continue
+            for neighbor in get_neighbors(cell, width, height):
+                i, j = neighbor
+                if neighbor != goal and not sea[i][j]:
+                    continue
+                new_distance = distance + costs[i][j]
+                if new_distance < distances.get(neighbor, float("inf")):
+                    distances[neighbor] = new_distance
+                    parents[neighbor] = cell
+                    heapq.heappush(queue, (new_distance + heuristic(neighbor),
+                                           new_distance, neighbor))
+        return None
+    
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+    
+    def cache_clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class TrafficIndex:
+    ''' Running tallies of where the ships are, for constant-time lookups.
+
+    Keeps track of which ships are docked at each port, how many ships are
+    on each cell and sailing each lane (and towards each port), and when
+    each port's recent arrivals and departures happened. The ships keep it
+    up to date themselves as they depart, sail and arrive.
+    '''
+
+    def __init__(self, model, window=50):
+        '''
+        Args:
+            model: The parent model
+            window: Number of steps to count arrivals and departures over
+        '''
+        self.model = model
+        self.window = window
+        self.docked = {name: set() for name in model.ports}
+        self.cell_counts = np.zeros((model.width, model.height), dtype=int)
+        self.lane_counts = Counter()
+        self.incoming = Counter()
+        self.arrivals = {name: deque() for name in model.ports}
+        self.departures = {name: deque() for name in model.ports}
+
+    def add_ship(self, ship):
+        ''' Start tracking a ship docked at its current port.
+        '''
+        self.docked[ship.current_port].add(ship)
+        x, y = ship.pos
+        self.cell_counts[x, y] += 1
+
+    def depart(self, ship, origin, destination):
+        self.docked[origin].discard(ship)
+        self.lane_counts[(origin, destination)] += 1
+        self.incoming[destination] += 1
+        self.add_event(self.departures[origin])
+
+    def move(self, old_pos, new_pos):
+        self.cell_counts[old_pos] -= 1
+        self.cell_counts[new_pos] += 1
+
+    def arrive(self, ship, origin, destination):
+        self.docked[destination].add(ship)
+        self.lane_counts[(origin, destination)] -= 1
+        self.incoming[destination] -= 1
+        self.add_event(self.arrivals[destination])
+
+    def ships_at(self, pos):
+        ''' Number of ships in a cell, whether sailing or docked.
+        '''
+        return int(self.cell_counts[pos])
+
+    def add_event(self, events):
+        ''' Log an arrival or departure now, forgetting any that have fallen
+        out of the window, so the log never holds more than a window's worth.
+        '''
+        events.append(self.model.schedule.steps)
+        self.get_recent(events)
+
+    def get_recent(self, events):
+        ''' Drop events from before the window, and count the rest.
+        '''
+        start = self.model.schedule.steps - self.window
+        while events and events[0] < start:
+            events.popleft()
+        return len(events)
+
+    def throughput(self, port):
+        ''' Arrivals plus departures per step at a port, over the window.
+        '''
+        return (self.get_recent(self.arrivals[port])
+                + self.get_recent(self.departures[port])) / self.window
+
+    def congestion(self, port):
+        ''' Ships at a port or on their way there.
+        '''
+        return len(self.docked[port]) + self.incoming[port]
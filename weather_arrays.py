@@ -0,0 +1,484 @@
+'''
+Array form of the weather submodel
+
+The weather state is a handful of (width, height) numpy arrays, one per field,
+and a weather step is a fixed sequence of stages over them. Each stage only
+reads fields that no other part of the same stage writes, and computes every
+cell from a small neighborhood around it. That means the world can be cut into
+tiles that are stepped independently -- here, by worker processes sharing the
+arrays via `multiprocessing.shared_memory` -- and still give bit-for-bit the
+same result as stepping the whole world at once.
+
+Halo exchange is implicit: all the fields live in shared memory, so a tile
+simply reads the cells around its edges (wrapping around the torus) once
+every tile has finished the previous stage.
+'''
+
+import math
+import multiprocessing as mp
+import time
+import weakref
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+FIELDS = {"temperature": np.float64,
+          "humidity": np.float64,
+          "air": np.float64,
+          "next_temperature": np.float64,
+          "next_humidity": np.float64,
+          "next_air": np.float64,
+          "average_temperature": np.float64,
+          "average_humidity": np.float64,
+          "average_air": np.float64,
+          "wind_u": np.float64,
+          "wind_v": np.float64,
+          "land_cover": np.float64,
+          "cloudy": np.bool_,
+          "raining": np.bool_}
+
+STAGES = ["convey_weather", "update_cell", "average_cell", "update_weather"]
+
+
+def make_fields(width, height):
+    ''' Allocate a fresh set of weather fields in ordinary memory.
+    '''
+    return {name: np.zeros((width, height), dtype)
+            for name, dtype in FIELDS.items()}
+
+def is_cloudy(temperature, humidity):
+    return humidity > 0.6 + 0.3 * temperature
+
+def is_raining(temperature, humidity):
+    return humidity > 0.6 + 0.5 * temperature
+
+def get_halo(fields, name, tile, halo):
+    ''' Copy a field over a tile plus `halo` cells on every side, wrapping
+    around the edges of the torus.
+
+    Returns the padded array and the (wrapped) x and y coordinates of its
+    rows and columns.
+    '''
+    x0, x1, y0, y1 = tile
+    width, height = fields[name].shape
+    xs = np.arange(x0 - halo, x1 + halo) % width
+    ys = np.arange(y0 - halo, y1 + halo) % height
+    return fields[name][np.ix_(xs, ys)], xs, ys
+
+
+def convey_weather(fields, tile, parameters, reach):
+    ''' Carry the air, and its temperature and humidity, downwind.
+
+    Each cell's air lands at its position plus its wind vector -- which is in
+    world cells, so gets divided by the resolution -- generally between four
+    cells, and is split between them with bilinear weights. The amount of air
+    in each cell is tracked, and the air and the moisture it holds are added
+    up where they land, so none of either is created or lost. Humidity and
+    temperature stay concentrations: the mean of the air arriving, weighted
+    by how much of it there is. Cells no air reaches keep their own.
+
+    Every cell within `reach` of the tile sends its four shares out, and each
+    target adds up what it gets with np.bincount, one source at a time, so
+    the cost doesn't grow with the reach. The sources for any one target
+    always come in the same order -- by their position relative to it -- so
+    the result is the same no matter how the world is split into tiles or
+    which cell goes first.
+
+    A grid too narrow for `check_reach` can't be split into tiles, but can
+    still be stepped as a whole: then the shares just wrap around the torus
+    instead of going through a halo, which would count some sources twice.
+    '''
+    x0, x1, y0, y1 = tile
+    width, height = fields["temperature"].shape
+    nx, ny = x1 - x0, y1 - y0
+    wrap = (nx, ny) == (width, height) and not fits_reach(width, height,
+                                                          reach)
+    halo = 0 if wrap else reach
+    temperature, _, _ = get_halo(fields, "temperature", tile, halo)
+    humidity, _, _ = get_halo(fields, "humidity", tile, halo)
+    air, _, _ = get_halo(fields, "air", tile, halo)
+    wind_u, _, _ = get_halo(fields, "wind_u", tile, halo)
+    wind_v, _, _ = get_halo(fields, "wind_v", tile, halo)
+    wind_u = wind_u / parameters["resolution"]
+    wind_v = wind_v / parameters["resolution"]
+    # Each source splits between offsets (dx, dy) to (dx + 1, dy + 1)
+    dx = np.floor(wind_u)
+    dy = np.floor(wind_v)
+    fx = wind_u - dx
+    fy = wind_v - dy
+    w = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy),
+                  (1 - fx) * fy, fx * fy], axis=-1) * air[..., None]
+
+    if wrap:
+        # Target of each share, wrapped around the torus
+        tx = (np.arange(width)[:, None, None] + dx.astype(int)[..., None]
+              + [0, 1, 0, 1]) % width
+        ty = (np.arange(height)[None, :, None] + dy.astype(int)[..., None]
+              + [0, 0, 1, 1]) % height
+        target = (tx * height + ty).ravel()
+        order = slice(None)
+        mx, my = width, height
+        tile_cells = (slice(None), slice(None))
+    else:
+        # Target of each source's four shares. Targets are counted in a
+        # margin of `reach` + 1 cells around the padded tile (as far as any
+        # share can land), so no share needs to be filtered out. Last source
+        # first, so each target adds up its shares in order of offset,
+        # whatever the tiling.
+        mx, my = nx + 4 * reach + 2, ny + 4 * reach + 2
+        tx = np.arange(nx + 2 * reach)[:, None] + dx.astype(int) + reach
+        ty = np.arange(ny + 2 * reach)[None, :] + dy.astype(int) + reach
+        target = (tx * my + ty)[..., None] + [0, my, 1, my + 1]
+        order = slice(None, None, -1)
+        target = target.ravel()[order]
+        tile_cells = (slice(2 * reach, 2 * reach + nx),
+                      slice(2 * reach, 2 * reach + ny))
+    heat = (w * temperature[..., None]).ravel()[order]
+    moisture = (w * humidity[..., None]).ravel()[order]
+    w = w.ravel()[order]
+    air = np.bincount(target, w, mx * my).reshape(mx, my)[tile_cells]
+    heat = np.bincount(target, heat, mx * my).reshape(mx, my)[tile_cells]
+    moisture = np.bincount(target, moisture,
+                           mx * my).reshape(mx, my)[tile_cells]
+
+    own = (slice(halo, halo + nx), slice(halo, halo + ny))
+    arrived = air > 0
+    divisor = np.where(arrived, air, 1)
+    fields["next_temperature"][x0:x1, y0:y1] = np.where(
+        arrived, heat / divisor, temperature[own])
+    fields["next_humidity"][x0:x1, y0:y1] = np.where(
+        arrived, moisture / divisor, humidity[own])
+    fields["next_air"][x0:x1, y0:y1] = air
+
+def update_cell(fields, tile, parameters, reach):
+    ''' Heat and moisten the air according to what's under it and the sky.
+    '''
+    x0, x1, y0, y1 = tile
+    cell = (slice(x0, x1), slice(y0, y1))
+    temperature = fields["next_temperature"][cell]
+    humidity = fields["next_humidity"][cell]
+    land_cover = fields["land_cover"][cell]
+    cloudy = fields["cloudy"][cell]
+    raining = fields["raining"][cell]
+
+    # Update temperature, blending the land and water rates by land cover
+    delta = (land_cover * parameters["land_temp"]
+             + (1 - land_cover) * parameters["water_temp"])
+    delta = np.where(cloudy, delta * parameters["cloudy_factor"], delta)
+    temperature = temperature + delta
+    temperature = np.where(raining, temperature - delta, temperature)
+    # Adjust for wind speed
+    # Faster winds cool the air down
+    # Assumes the wind speed is roughly in the (0, 3) range
+    wind_speed = (fields["wind_u"][cell]**2 + fields["wind_v"][cell]**2)**0.5
+    temperature = temperature - wind_speed * 0.01
+
+    # Update humidity
+    gain = (land_cover * parameters["land_humidity"]
+            + (1 - land_cover) * parameters["water_humidity"])
+    humidity = np.where(raining, humidity * 0.8, humidity + gain)
+
+    fields["temperature"][cell] = temperature
+    fields["humidity"][cell] = humidity
+    fields["air"][cell] = fields["next_air"][cell]
+
+def average_cell(fields, tile, parameters, reach):
+    ''' Mix each cell's air half-and-half with the mean of its 3x3
+    neighborhood.
+
+    The air and the heat and moisture it carries are mixed, and then turned
+    back into temperature and humidity, so the mixing conserves them too.
+    '''
+    x0, x1, y0, y1 = tile
+    nx, ny = x1 - x0, y1 - y0
+    cell = (slice(x0, x1), slice(y0, y1))
+    air, _, _ = get_halo(fields, "air", tile, 1)
+    mixed = {}
+    for name in ["air", "temperature", "humidity"]:
+        padded = air
+        if name != "air":
+            padded = padded * get_halo(fields, name, tile, 1)[0]
+        nearby = 0
+        for ox in range(3):
+            for oy in range(3):
+                nearby = nearby + padded[ox:ox + nx, oy:oy + ny]
+        nearby = nearby / 9
+        mixed[name] = (padded[1:1 + nx, 1:1 + ny] + nearby) / 2
+    has_air = mixed["air"] > 0
+    divisor = np.where(has_air, mixed["air"], 1)
+    fields["average_air"][cell] = mixed["air"]
+    for name in ["temperature", "humidity"]:
+        fields["average_" + name][cell] = np.where(
+            has_air, mixed[name] / divisor, fields[name][cell])
+
+def update_weather(fields, tile, parameters, reach):
+    ''' Commit the averages and check for clouds and rain.
+    '''
+    x0, x1, y0, y1 = tile
+    cell = (slice(x0, x1), slice(y0, y1))
+    temperature = fields["average_temperature"][cell]
+    humidity = fields["average_humidity"][cell]
+    fields["temperature"][cell] = temperature
+    fields["humidity"][cell] = humidity
+    fields["air"][cell] = fields["average_air"][cell]
+    fields["cloudy"][cell] = is_cloudy(temperature, humidity)
+    fields["raining"][cell] = is_raining(temperature, humidity)
+
+
+def step_tile(fields, stage, tile, parameters, reach):
+    ''' Run one stage of the weather step over one tile.
+    '''
+    globals()[stage](fields, tile, parameters, reach)
+
+def weather_step(fields, parameters, reach):
+    ''' Run a full weather step over the whole world in this process.
+    '''
+    width, height = fields["temperature"].shape
+    tile = (0, width, 0, height)
+    for stage in STAGES:
+        step_tile(fields, stage, tile, parameters, reach)
+
+def get_reach(fields, resolution=1):
+    ''' How many air cells the wind can carry the air in one step.
+    '''
+    return int(math.ceil(max(np.abs(fields["wind_u"]).max(),
+                             np.abs(fields["wind_v"]).max()) / resolution))
+
+def fits_reach(width, height, reach):
+    ''' Whether no cell can be carried all the way around the torus, which
+    would make a tile's halo count a cell twice.
+    '''
+    return 2 * reach + 1 <= min(width, height)
+
+def check_reach(width, height, reach):
+    ''' Make sure a grid can be split into tiles for this reach.
+    '''
+    if not fits_reach(width, height, reach):
+        raise Exception("Wind is too fast for the size of the weather grid")
+
+def make_tiles(width, height, n_tiles):
+    ''' Split the world into n_tiles rectangles, as close to square as
+    the factors of n_tiles allow.
+    '''
+    nx = max(i for i in range(1, n_tiles + 1)
+             if n_tiles % i == 0 and i * i <= n_tiles * width / height)
+    ny = n_tiles // nx
+    xs = np.linspace(0, width, nx + 1).astype(int)
+    ys = np.linspace(0, height, ny + 1).astype(int)
+    return [(int(xs[i]), int(xs[i + 1]), int(ys[j]), int(ys[j + 1]))
+            for i in range(nx) for j in range(ny)]
+
+
+def _attach(blocks):
+    ''' Map the shared memory blocks to a set of fields.
+    '''
+    memory = {name: SharedMemory(name=block_name)
+              for name, (block_name, shape) in blocks.items()}
+    fields = {name: np.ndarray(shape, FIELDS[name], memory[name].buf)
+              for name, (block_name, shape) in blocks.items()}
+    return memory, fields
+
+def _work(blocks, tile, parameters, connection):
+    ''' Worker loop: step one tile each time the main process says go.
+
+    The main process sends the reach to start a step (or None to stop), and
+    True to start each later stage once every tile is done with the one
+    before. The worker answers after each stage.
+    '''
+    memory, fields = _attach(blocks)
+    try:
+        while True:
+            reach = connection.recv()
+            if reach is None:
+                break
+            for i, stage in enumerate(STAGES):
+                if i > 0 and not connection.recv():
+                    return
+                step_tile(fields, stage, tile, parameters, reach)
+                connection.send(True)
+    except EOFError:
+        # The main process is gone
+        return
+    del fields
+    for block in memory.values():
+        block.close()
+
+def _shutdown(workers, connections, memory, timeout):
+    ''' Stop the workers and free the shared memory.
+
+    Asks each live worker to stop, and terminates any that don't within
+    `timeout` seconds.
+    '''
+    for worker, connection in zip(workers, connections):
+        if worker.is_alive():
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+    for worker, connection in zip(workers, connections):
+        worker.join(timeout)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+        connection.close()
+    for block in memory.values():
+        block.close()
+        block.unlink()
+
+class TiledWeather:
+    ''' Weather fields in shared memory, stepped tile-by-tile by a pool of
+    worker processes.
+
+    The workers run each stage on their own tile and report back, and the
+    main process only lets them start the next stage once every tile is done,
+    so that nobody reads a neighboring tile's edge before its owner is done
+    writing it. If a worker dies, or a stage takes longer than `timeout`
+    seconds, the step raises an exception instead of waiting forever, and the
+    tiled weather can't be stepped again.
+    '''
+
+    # Longest to wait for the workers to finish a stage, in seconds
+    timeout = 60
+
+    def __init__(self, width, height, processes, parameters):
+        ''' Allocate the shared fields and start the workers.
+
+        Args:
+            width, height: Dimensions of the weather grid
+            processes: Number of worker processes (and tiles)
+            parameters: Weather model parameters, as a dictionary
+        '''
+        self.width = width
+        self.height = height
+        self.processes = processes
+        self.tiles = make_tiles(width, height, processes)
+
+        self.memory = {}
+        self.fields = {}
+        blocks = {}
+        for name, dtype in FIELDS.items():
+            size = width * height * np.dtype(dtype).itemsize
+            block = SharedMemory(create=True, size=size)
+            self.memory[name] = block
+            self.fields[name] = np.ndarray((width, height), dtype, block.buf)
+            self.fields[name][:] = 0
+            blocks[name] = (block.name, (width, height))
+
+        self.broken = False
+        self.workers = []
+        self.connections = []
+        for tile in self.tiles:
+            connection, worker_connection = mp.Pipe()
+            worker = mp.Process(target=_work, daemon=True,
+                                args=(blocks, tile, parameters,
+                                      worker_connection))
+            worker.start()
+            worker_connection.close()
+            self.workers.append(worker)
+            self.connections.append(connection)
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self.workers, self.connections, self.memory,
+            self.timeout)
+
+    def wait_for_workers(self):
+        ''' Wait for every worker to report that it's done with a stage.
+
+        Watches the worker processes as well as their connections, so a
+        worker that dies is noticed right away rather than at the timeout.
+        '''
+        pending = dict(zip(self.connections, self.workers))
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            sentinels = {worker.sentinel: worker
+                         for worker in pending.values()}
+            ready = wait(list(pending) + list(sentinels),
+                         max(deadline - time.monotonic(), 0))
+            if not ready:
+                self.fail("timed out")
+            for connection in [r for r in ready if r in pending]:
+                try:
+                    connection.recv()
+                except EOFError:
+                    self.fail("died")
+                del pending[connection]
+            if any(sentinels[r] in pending.values()
+                   for r in ready if r in sentinels):
+                self.fail("died")
+
+    def fail(self, reason):
+        ''' Give up on the workers after one of them failed.
+        '''
+        self.broken = True
+        for worker in self.workers:
+            worker.join(0.1)
+        exit_codes = [worker.exitcode for worker in self.workers]
+        self._finalizer()
+        self.fields = {}
+        raise Exception(f"A weather worker {reason} during a step (exit "
+                        f"codes: {exit_codes})")
+
+    def step(self, reach):
+        ''' Run one weather step across all the tiles.
+        '''
+        if self.broken:
+            raise Exception("A weather worker failed; the tiled weather "
+                            "can't be stepped any more")
+        check_reach(self.width, self.height, reach)
+        for i in range(len(STAGES)):
+            try:
+                for connection in self.connections:
+                    connection.send(reach if i == 0 else True)
+            except OSError:
+                self.fail("died")
+            self.wait_for_workers()
+
+    def close(self):
+        ''' Stop the workers and release the shared memory.
+        '''
+        self.fields = {}
+        self._finalizer()
+
+
+if __name__ == "__main__":
+    # Benchmark: time the weather step on a large world for increasing
+    # numbers of processes, and check every tiling gives the same result.
+    import sys
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_steps = 5
+    parameters = {"land_temp": 0.012, "water_temp": 0.01,
+                  "cloudy_factor": 0.75, "land_humidity": 0.01,
+                  "water_humidity": 0.05, "resolution": 1}
+    rng = np.random.default_rng(0)
+    start_fields = make_fields(size, size)
+    start_fields["temperature"][:] = 0.7
+    start_fields["humidity"][:] = rng.random((size, size))
+    start_fields["next_temperature"][:] = start_fields["temperature"]
+    start_fields["next_humidity"][:] = start_fields["humidity"]
+    start_fields["air"][:] = 1
+    start_fields["land_cover"][:] = rng.random((size, size)) < 0.25
+    start_fields["wind_u"][:] = rng.uniform(-3, 2, (size, size))
+    start_fields["wind_v"][:] = rng.uniform(-3, 2, (size, size))
+    reach = get_reach(start_fields)
+
+    fields = {name: field.copy() for name, field in start_fields.items()}
+    t = time.perf_counter()
+    for _ in range(n_steps):
+        weather_step(fields, parameters, reach)
+    baseline = (time.perf_counter() - t) / n_steps
+    print(f"{size}x{size}, 1 process: {baseline:.3f} s/step")
+
+    for processes in [2, 4, 8]:
+        tiled = TiledWeather(size, size, processes, parameters)
+        for name, field in start_fields.items():
+            tiled.fields[name][:] = field
+        t = time.perf_counter()
+        for _ in range(n_steps):
+            tiled.step(reach)
+        elapsed = (time.perf_counter() - t) / n_steps
+        match = all(np.array_equal(tiled.fields[name], fields[name])
+                    for name in FIELDS)
+        print(f"{size}x{size}, {processes} processes: {elapsed:.3f} s/step, "
+              f"speedup {baseline / elapsed:.2f}x, exact match: {match}")
+        tiled.close()
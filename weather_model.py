@@ -3,153 +3,265 @@ Weather submodel
 '''
 
 from itertools import product
+import math
 import numpy as np
-from mesa import Agent
 from utils import rotate_vector
+from weather_arrays import (make_fields, weather_step, get_reach, check_reach,
+                            is_cloudy, is_raining, TiledWeather)
 
-class AirCell(Agent):
+class AirCell:
+    ''' The air over one world cell.
+
+    Holds no state of its own: the weather lives in the weather submodel's
+    field arrays, and every attribute is looked up there on demand (and
+    interpolated, if the weather runs at a coarser resolution than the world).
+    This keeps the world grid's "Weather" layer readable by ships and the
+    front-end.
+    '''
     layer = "Weather"
-    
+
+    def __init__(self, weather):
+        self.weather = weather
+        self.pos = None  # Will get handled when placed on the grid.
+
+    @property
+    def temperature(self):
+        return self.weather.sample(self.pos, "temperature")
+
+    @property
+    def humidity(self):
+        return self.weather.sample(self.pos, "humidity")
+
+    @property
+    def wind_vector(self):
+        return (self.weather.sample(self.pos, "wind_u"),
+                self.weather.sample(self.pos, "wind_v"))
+
+    @property
+    def cloudy(self):
+        return bool(is_cloudy(self.temperature, self.humidity))
+
+    @property
+    def raining(self):
+        return bool(is_raining(self.temperature, self.humidity))
+
+class WeatherSubmodel:
+    ''' Convenience class to group the methods involved in the weather submodel
+    '''
+
     # Weather model parameters
     land_temp = 0.012
     water_temp = 0.01 #0.005
     cloudy_factor = 0.75 #0.5
-    
+
     land_humidity = 0.01
     water_humidity = 0.05
     rain_temp = -0.02
-    
-    def __init__(self, unique_id, model, starting_temp, starting_humidity,
-                 wind_vector=[0,0]):
-        self.unique_id = unique_id
-        self.model = model
-        self.temperature = starting_temp
-        self.humidity = starting_humidity
-        self.wind_vector = wind_vector
-        self.next_temperature = self.temperature
-        self.next_humidity = self.humidity
-        self.pos = (-1, -1)
-        
-        self.cloudy = False
-        self.raining = False
-    
-    def convey_weather(self):
-        ''' Carry temperature and humidity to the next cell based on the wind
-        '''
-        grid = self.model.grid
-        x, y = self.pos
-        next_x = round(x + self.wind_vector[0])
-        next_y = round(y + self.wind_vector[1])
-        next_x, next_y = grid.torus_adj((next_x, next_y))
-        next_cell = grid[next_x][next_y]["Weather"]
-        next_cell.next_temperature = self.temperature
-        next_cell.next_humidity = self.humidity
-    
-    def update_cell(self):
-        self.temperature = self.next_temperature
-        self.humidity = self.next_humidity
-        
-        grid = self.model.grid
-        x, y = self.pos
-        # Update temperature
-        if grid[x][y]["Land"] is not None:
-            delta = self.land_temp
-        else:
-            delta = self.water_temp
-        if self.cloudy:
-            delta *= self.cloudy_factor
-        self.temperature += delta
-        if self.raining:
-            self.temperature -= delta
-        # Adjust for wind speed
-        # Faster winds cool the air down
-        # Assumes the wind speed is roughly in the (0, 3) range
-        wind_speed = (self.wind_vector[0]**2 + self.wind_vector[1]**2)**0.5
-        self.temperature -= wind_speed * 0.01
-        
-        # Update humidity
-        if self.raining:
-            #self.humidity -= 0.05
-            self.humidity *= 0.8
-        elif grid[x][y]["Land"] is None:
-            self.humidity += self.water_humidity
-        else:
-            self.humidity += self.land_humidity
-            #self.humidity += np.random.normal(0.03, 0.01)
-        
-    def average_cell(self):
-        neighbors = self.model.grid.get_neighbors(self.pos, True, True)
-        neighbors = [cell for cell in neighbors if cell.layer=="Weather"]
-        nearby_temp = sum(cell.temperature for cell in neighbors)/len(neighbors)
-        nearby_humidity = sum(cell.humidity for cell in neighbors)/len(neighbors)
-        self.temperature = (self.temperature + nearby_temp)/2
-        self.humidity = (self.humidity + nearby_humidity)/2
-    
-    
-    def update_weather(self):
-        self.cloudy = (self.humidity > 0.6 + 0.3 * self.temperature)    
-        self.raining =  (self.humidity > 0.6 + 0.5 * self.temperature)
 
-class WeatherSubmodel:
-    ''' Convenience class to group the methods involved in the weather submodel
-    '''
-    def __init__(self, model):
+    # Fastest the wind from `update_wind` can blow, in world cells per step
+    max_wind = 3
+
+    def __init__(self, model, update_every=1, substeps=1, resolution=1,
+                 processes=1):
         ''' Instantiate a weather submodel attached to the parent model
+
+        Args:
+            model: The parent model
+            update_every: Run the weather once every this many agent steps
+            substeps: How many weather steps to run each time it does run
+            resolution: Side length, in world cells, of the square block of
+                        the world covered by a single air cell
+            processes: Number of worker processes to split the weather grid
+                       between; 1 steps it in this process
         '''
-        
+
         self.model = model
         # Convenience pass-throughs to keep line lengths shorter
         self.grid = model.grid
         self.random = model.random
-        
-        self.width = model.width
-        self.height = model.height
-        
-        self.weather_cells = []
+
+        for name, value in [("update_every", update_every),
+                            ("substeps", substeps),
+                            ("resolution", resolution)]:
+            if value < 1:
+                raise Exception(f"Weather `{name}` must be at least 1")
+
+        # Weather clock
+        self.update_every = update_every
+        self.substeps = substeps
+        self.clock = 0
+        # Number of weather steps run so far
+        self.epoch = 0
+
+        # Weather grid
+        if model.width % resolution or model.height % resolution:
+            raise Exception("World dimensions must be divisible by the "
+                            "weather `resolution`")
+        self.resolution = resolution
+        self.width = model.width // resolution
+        self.height = model.height // resolution
+        self.processes = processes
+        if processes > 1:
+            # Tiles need room for the fastest wind `update_wind` can make
+            check_reach(self.width, self.height,
+                        math.ceil(self.max_wind / resolution))
+        self.tiles = None
+        self.fields = None
+
         starting_wind_direction = self.random.randrange(0, 360)
-        self.wind = rotate_vector(np.array([1, 0]), 
+        self.wind = rotate_vector(np.array([1, 0]),
                                   np.radians(starting_wind_direction))
-        
-    def setup_weather(self):        
-        self.weather_cells = []
-        for (x, y) in product(range(self.width), range(self.height)):
-            weather_cell = AirCell(f"Cell{x}{y}", self.model, 0.7, 
-                                    self.model.random.random(), (0, 0))
-            #self.schedule.add(weather_cell)
-            self.weather_cells.append(weather_cell)
-            self.model.grid.place_agent(weather_cell, (x, y))
+
+    @property
+    def parameters(self):
+        return {"land_temp": self.land_temp,
+                "water_temp": self.water_temp,
+                "cloudy_factor": self.cloudy_factor,
+                "land_humidity": self.land_humidity,
+                "water_humidity": self.water_humidity,
+                "resolution": self.resolution}
+
+    def setup_weather(self):
+        if self.processes > 1:
+            self.tiles = TiledWeather(self.width, self.height, self.processes,
+                                      self.parameters)
+            self.fields = self.tiles.fields
+        else:
+            self.fields = make_fields(self.width, self.height)
+
+        self.fields["temperature"][:] = 0.7
+        self.fields["humidity"][:] = np.reshape(
+            [self.random.random() for _ in range(self.width * self.height)],
+            (self.width, self.height))
+        self.fields["next_temperature"][:] = self.fields["temperature"]
+        self.fields["next_humidity"][:] = self.fields["humidity"]
+        self.fields["air"][:] = 1
+        self.fields["next_air"][:] = 1
+        self.fields["land_cover"][:] = self.get_land_cover()
+
+        for (x, y) in product(range(self.model.width),
+                              range(self.model.height)):
+            self.grid.place_agent(AirCell(self), (x, y))
         self.update_wind()
-    
+
+    def get_land_cover(self):
+        ''' Fraction of the world cells under each air cell that are land.
+        '''
+        r = self.resolution
+        land = self.model.land
+        return land.reshape(self.width, r, self.height, r).mean(axis=(1, 3))
+
     def update_wind(self, wind=None):
         ''' Compute a vector field for winds and update all cells.
+
+        The wind is in world cells per step, and laid out over the world, so
+        it's the same whatever the weather resolution; each air cell gets the
+        wind at its center.
         '''
         if wind is None:
             wind = self.wind
-        
+
         # Set up the wind vector field
         scale = 1
-        x = np.linspace(-scale, scale, self.width)
-        y = np.linspace(-scale, scale, self.height)
-        X, Y = np.meshgrid(x, y)
+        r = self.resolution
+        x = np.linspace(-scale, scale, self.model.width)
+        y = np.linspace(-scale, scale, self.model.height)
+        x = x.reshape(self.width, r).mean(axis=1)
+        y = y.reshape(self.height, r).mean(axis=1)
+        # Arrays are indexed [x, y], so meshgrid's X runs along y, and Y
+        # along x; kept that way so square worlds get the same winds as ever
+        X, Y = np.meshgrid(y, x)
         U = wind[0] - X**2 + Y
         V = wind[1] + X - Y**2
-        for (x, y) in product(range(self.width), range(self.height)):
-            wind_vector = [float(U[x, y]), float(V[x, y])]
-            self.grid[x][y]["Weather"].wind_vector = wind_vector
-    
+        self.fields["wind_u"][:] = U
+        self.fields["wind_v"][:] = V
+
+    def sample(self, pos, field):
+        ''' Get the value of a weather field at a world grid position.
+
+        At full resolution this is just the value for the air cell at that
+        position; otherwise it is bilinearly interpolated between the four
+        air cells whose centers surround the center of the world cell.
+        '''
+        x, y = pos
+        values = self.fields[field]
+        if self.resolution == 1:
+            return float(values[x, y])
+        # Position of the world cell's center, in air cell coordinates
+        u = (x + 0.5) / self.resolution - 0.5
+        v = (y + 0.5) / self.resolution - 0.5
+        x0, y0 = math.floor(u), math.floor(v)
+        fx, fy = u - x0, v - y0
+        value = 0
+        for dx, wx in [(0, 1 - fx), (1, fx)]:
+            for dy, wy in [(0, 1 - fy), (1, fy)]:
+                cx = (x0 + dx) % self.width
+                cy = (y0 + dy) % self.height
+                value += wx * wy * float(values[cx, cy])
+        return value
+
+    def sample_field(self, field):
+        ''' Get a weather field at every world grid position, interpolated
+        exactly as `sample` does it.
+        '''
+        values = self.fields[field]
+        r = self.resolution
+        if r == 1:
+            return values.copy()
+        u = (np.arange(self.model.width) + 0.5) / r - 0.5
+        v = (np.arange(self.model.height) + 0.5) / r - 0.5
+        x0, y0 = np.floor(u).astype(int), np.floor(v).astype(int)
+        fx, fy = u - x0, v - y0
+        value = 0
+        for dx, wx in [(0, 1 - fx), (1, fx)]:
+            for dy, wy in [(0, 1 - fy), (1, fy)]:
+                cx = (x0 + dx) % self.width
+                cy = (y0 + dy) % self.height
+                value = value + (wx[:, None] * wy[None, :]
+                                 * values[np.ix_(cx, cy)])
+        return value
+
+    def get_sky(self):
+        ''' Whether it's cloudy and whether it's raining at every world grid
+        position, as arrays; the same as the `AirCell`s there would say.
+        '''
+        temperature = self.sample_field("temperature")
+        humidity = self.sample_field("humidity")
+        return (is_cloudy(temperature, humidity),
+                is_raining(temperature, humidity))
+
+    def step(self):
+        ''' Advance the weather clock by one agent timestep.
+
+        Runs `substeps` weather steps once every `update_every` agent steps.
+        '''
+        self.clock += 1
+        if self.clock % self.update_every == 0:
+            for _ in range(self.substeps):
+                self.weather_step()
+
     def weather_step(self):
         ''' Advance the weather by one timestep.
-        
+
         Not handled via the parent model's scheduler since (a) the sequential
         multi-stage updating doesn't play nicely with most schedulers, and
         (b) one weather timestep may not be the same as one agent timestep.
-        '''   
+        The stages themselves are in `weather_arrays`.
+        '''
         # Rotate the global wind vector randomly and update
         self.wind = rotate_vector(self.wind, self.random.normalvariate(0, 0.5))
         self.update_wind()
-        # Run each method for each cell; this is easier than four for loops
-        for method in ["convey_weather", "update_cell", 
-                       "average_cell", "update_weather"]:
-            for cell in self.weather_cells:
-                getattr(cell, method)()
-    
\ No newline at end of file
+        reach = get_reach(self.fields, self.resolution)
+        if self.tiles is not None:
+            self.tiles.step(reach)
+        else:
+            weather_step(self.fields, self.parameters, reach)
+        self.epoch += 1
+
+    def close(self):
+        ''' Shut down the weather worker processes, if there are any.
+        '''
+        if self.tiles is not None:
+            self.fields = None
+            self.tiles.close()
+            self.tiles = None